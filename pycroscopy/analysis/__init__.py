@@ -7,9 +7,14 @@ Submodules
 .. autosummary::
     :toctree: _autosummary
 
+    giv_bayesian
+    utils
+
 """
 
 from . import utils
 from .utils import *
+from . import giv_bayesian
+from .giv_bayesian import GIVBayesian
 
-__all__ = utils.__all__
+__all__ = ['GIVBayesian'] + utils.__all__
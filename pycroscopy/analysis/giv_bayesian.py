@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+A class for Bayesian inference of resistance and capacitance from General-mode I-V spectroscopic imaging data
+
+Created on Thu Nov 02 11:48:53 2017
+
+@author: Suhas Somnath, Kody J. Law, Rama K. Vasudevan
+
+"""
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from threading import Thread
+import numpy as np
+
+from sidpy.hdf.hdf_utils import get_attr, write_simple_attrs
+from sidpy.proc.comp_utils import parallel_compute
+
+from pyUSID import USIDataset
+from pyUSID.io.hdf_utils import create_results_group, write_main_dataset
+from pyUSID.io.write_utils import Dimension
+from pyUSID.processing.process import Process
+
+from .utils.giv_utils import do_bayesian_inference, bayesian_inference_on_period, cap_dtype
+
+# TODO: Take lesser used bayesian inference params from kwargs if provided
+
+
+def _full_period_inference(single_i, rev_bias, forw_bias, ex_freq, split_ind, **bayes_parms):
+    """
+    Performs Bayesian inference on both halves of a single pixel's I-V curve.
+
+    Fusing the halves into a single task lets GIVBayesian dispatch one worker pool per chunk, so the constant
+    arguments (bias vectors, frequency, inference parameters) are serialized to the workers only once per chunk.
+
+    Parameters
+    ----------
+    single_i : 1D float array
+        Measured current (nA) for one pixel in the raw (unrolled) order
+    rev_bias : 1D float array
+        Falling (reverse) half of the rolled excitation bias (V)
+    forw_bias : 1D float array
+        Rising (forward) half of the rolled excitation bias (V)
+    ex_freq : float
+        Frequency of the excitation waveform (Hz)
+    split_ind : uint
+        Index in the raw measurement at which the falling half of the rolled waveform begins
+    bayes_parms : dict
+        Other parameters that will be passed on to do_bayesian_inference()
+
+    Returns
+    -------
+    forw_results : dict
+        Inference results for the rising (forward) half of the waveform
+    rev_results : dict
+        Inference results for the falling (reverse) half of the waveform
+    """
+    # Slicing the raw row here is equivalent to rolling it by split_ind points:
+    half_v_steps = rev_bias.size
+    rev_i = single_i[split_ind: split_ind + half_v_steps]
+    forw_i = np.concatenate((single_i[split_ind + half_v_steps:], single_i[:split_ind]))
+
+    # The model is odd in (I, V), so the falling half can be inferred directly on its descending bias.
+    # Flipping it to a rising bias would only relabel the results at the cost of two copies per pixel:
+    rev_results = do_bayesian_inference(rev_i, rev_bias, ex_freq, **bayes_parms)
+    forw_results = do_bayesian_inference(forw_i, forw_bias, ex_freq, **bayes_parms)
+    return forw_results, rev_results
+
+
+class GIVBayesian(Process):
+
+    def __init__(self, h5_main, ex_freq, gain, num_x_steps=250, r_extra=110, **kwargs):
+        """
+        Applies Bayesian Inference to General-mode I-V (G-IV) data to extract the true current
+
+        Parameters
+        ----------
+        h5_main : h5py.Dataset object
+            Dataset to process. Each row of this dataset should contain the current response of a single pixel to a
+            single period of the excitation waveform
+        ex_freq : float
+            Frequency of the excitation waveform (Hz)
+        gain : uint
+            Gain setting on the current amplifier (typically 7-9)
+        num_x_steps : uint (Optional, default = 250)
+            Total number of bias points at which the resistance will be inferred over both halves of the bipolar
+            excitation waveform
+        r_extra : float (Optional, default = 110 [Ohms])
+            Extra resistance in series with the sample that compensates for the effect of the cabling
+        h5_target_group : h5py.Group, optional. Default = None
+            Location where to look for existing results and to place newly
+            computed results. Use this kwarg if the results need to be written
+            to a different HDF5 file. By default, this value is set to the
+            parent group containing `h5_main`
+        kwargs : (Optional). dictionary
+            Please see Process class for additional inputs
+        """
+
+        super(GIVBayesian, self).__init__(h5_main, 'Bayesian_Inference', **kwargs)
+
+        self.gain = gain
+        self.ex_freq = ex_freq
+        self.r_extra = r_extra
+
+        # Each half of the waveform is inferred over num_x_steps // 2 bias points and that number must be odd
+        # for the bias vector to include 0 V - setting the lowest bit enforces this without a branch:
+        half_x_steps = (int(num_x_steps) // 2) | 1
+        self.num_x_steps = 2 * half_x_steps
+        if self.verbose and self.mpi_rank == 0:
+            print('ensuring that half steps should be odd, num_x_steps is now', self.num_x_steps)
+
+        self.h5_main = USIDataset(self.h5_main)
+
+        # take these from kwargs
+        bayesian_parms = {'gam': 0.03, 'e': 10.0, 'sigma': 10.0, 'sigmaC': 1.0, 'num_samples': 2E3}
+
+        self.parms_dict = {'freq': self.ex_freq, 'num_x_steps': self.num_x_steps, 'r_extra': self.r_extra}
+        self.parms_dict.update(bayesian_parms)
+
+        self.duplicate_h5_groups, self.partial_h5_groups = self._check_for_duplicates()
+
+        h5_spec_vals = self.h5_main.h5_spec_vals[0]
+        self.single_ao = np.squeeze(h5_spec_vals[()])
+
+        roll_cyc_fract = -0.25
+        self.roll_pts = int(self.single_ao.size * roll_cyc_fract)
+        self.rolled_bias = np.roll(self.single_ao, self.roll_pts)
+
+        # The two monotonic halves of the rolled bias are fixed - slice them out once here. Together with the
+        # split index below, the task function can slice each raw row directly instead of every chunk paying
+        # for a full np.roll copy of its data:
+        half_v_steps = self.single_ao.size // 2
+        self._split_ind = -self.roll_pts
+        self._rev_bias = np.ascontiguousarray(self.rolled_bias[:half_v_steps])
+        self._forw_bias = np.ascontiguousarray(self.rolled_bias[half_v_steps:])
+
+        # Cache the single_ao-derived terms used to correct every chunk as contiguous float32 so that the
+        # per-chunk arithmetic neither converts dtypes nor recomputes constants. The last point of dvdt
+        # simply repeats the previous one - fill the array in place instead of growing it via np.append:
+        dt = 1. / (self.ex_freq * self.single_ao.size)
+        self.dvdt = np.empty(self.single_ao.size, dtype=np.float32)
+        self.dvdt[:-1] = np.diff(self.single_ao) / dt
+        self.dvdt[-1] = self.dvdt[-2]
+        self._i_extra_coef = np.ascontiguousarray(2 * self.r_extra * self.single_ao, dtype=np.float32)
+        # Combined coefficient of the capacitance in the correction: i_cor = i_meas - C * (dV/dt + 2 * R * V):
+        self._i_cor_coef = self.dvdt + self._i_extra_coef
+
+        # The bias axis of the results depends only on the excitation amplitude - build it once instead of
+        # assembling it from the inference results. The rising half is inferred on an ascending grid and the
+        # falling half is stored in descending order:
+        max_volts = np.max(np.abs(self.single_ao))
+        forw_x = np.linspace(-max_volts, max_volts, self.num_x_steps // 2)
+        self._full_x_vec = np.hstack((forw_x, forw_x[::-1]))
+
+        self.reverse_results = None
+        self.forward_results = None
+        self._bayes_parms = None
+
+        # Structure-of-arrays buffers holding the results for the current chunk. They are allocated for the
+        # first chunk and reused for every following chunk of the same size:
+        self._cap_chunk = None
+        self._r_inf_chunk = None
+        self._r_var_chunk = None
+        self._i_cor_chunk = None
+        self._cap_write_buffer = None
+
+        # Background thread that flushes the previous chunk's results to HDF5, and any exception it raised -
+        # re-raised on the main thread at the next join point:
+        self._write_thread = None
+        self._write_error = None
+
+        self.h5_new_spec_vals = None
+        self.h5_cap = None
+        self.h5_variance = None
+        self.h5_resistance = None
+        self.h5_i_corrected = None
+
+    def _set_memory_and_cores(self, cores=None, man_mem_limit=None, mem_multiplier=1.0):
+        """
+        Checks hardware limitations such as memory, number of CPU cores and sets the recommended data chunk sizes
+        and the number of cores to be used by analysis methods.
+
+        Parameters
+        ----------
+        cores : uint, optional, Default = 1
+            How many cores to use for the computation.
+        man_mem_limit : uint, optional, Default = None (all available memory)
+            The amount a memory in Mb to use in the computation
+        mem_multiplier : float, optional. Default = 1
+            mem_multiplier is the number that will be multiplied with the
+            (byte) size of a single position in the source dataset in order to
+            better estimate the number of positions that can be processed at
+            any given time (how many pixels of the source and results datasets
+            can be retained in memory). The default value of 1.0 only accounts
+            for the source dataset. A value greater than 1 would account for
+            the size of results datasets as well.
+        """
+        super(GIVBayesian, self)._set_memory_and_cores(cores=cores, man_mem_limit=man_mem_limit,
+                                                       mem_multiplier=mem_multiplier)
+        # The base class only accounts for the raw data held in memory. Four (roughly) equally sized arrays
+        # are held per chunk here: raw, corrected current, resistance, variance:
+        self._max_pos_per_read = self._max_pos_per_read // 4
+        # Since these computations take far longer than functional fitting, do in smaller batches:
+        self._max_pos_per_read = min(1000, self._max_pos_per_read)
+
+    def test(self, pix_ind=None, show_plots=True):
+        """
+        Tests the inference on a single pixel (randomly chosen unless manually specified) worth of data.
+
+        Parameters
+        ----------
+        pix_ind : int, optional. default = random
+            Index of the pixel whose data will be used for the test
+        show_plots : bool, optional. default = True
+            Whether or not to plot the results
+
+        Returns
+        -------
+        results : dict
+            Dictionary from bayesian_inference_on_period() with the inference results for this pixel
+        """
+        if self.mpi_rank > 0:
+            return
+        if pix_ind is None:
+            pix_ind = np.random.randint(0, high=self.h5_main.shape[0])
+        other_params = self.parms_dict.copy()
+        # The excitation frequency is a positional argument to the function below:
+        _ = other_params.pop('freq')
+
+        return bayesian_inference_on_period(self.h5_main[pix_ind], self.single_ao, self.ex_freq,
+                                            show_plots=show_plots, **other_params)
+
+    def _create_results_datasets(self):
+        """
+        Creates hdf5 datasets and datagroups to hold the results
+        """
+        # create all h5 datasets here:
+        num_pos = self.h5_main.shape[0]
+
+        if self.verbose and self.mpi_rank == 0:
+            print('Now creating the datasets')
+
+        self.h5_results_grp = create_results_group(self.h5_main, self.process_name,
+                                                   h5_parent_group=self._h5_target_group)
+
+        write_simple_attrs(self.h5_results_grp, {'algorithm_author': 'Kody J. Law', 'last_pixel': 0})
+        write_simple_attrs(self.h5_results_grp, self.parms_dict)
+
+        if self.verbose and self.mpi_rank == 0:
+            print('created group: {}'.format(self.h5_results_grp.name))
+
+        # Chunk the large datasets by blocks of whole rows roughly 1 MiB in size - the chunk shapes guessed
+        # by HDF5 are far smaller than the batches being written, which makes the I/O needlessly seeky:
+        cc_chunks = (min(num_pos, max(1, 1024 * 1024 // (4 * self.single_ao.size))), self.single_ao.size)
+        res_chunks = (min(num_pos, max(1, 1024 * 1024 // (4 * self.num_x_steps))), self.num_x_steps)
+
+        # One of those rare instances when the result is shaped exactly the same as the source
+        self.h5_i_corrected = write_main_dataset(self.h5_results_grp, self.h5_main.shape, 'Corrected_Current',
+                                                 get_attr(self.h5_main, 'quantity'),
+                                                 get_attr(self.h5_main, 'units'), None, None,
+                                                 dtype=np.float32, chunks=cc_chunks,
+                                                 h5_pos_inds=self.h5_main.h5_pos_inds,
+                                                 h5_pos_vals=self.h5_main.h5_pos_vals,
+                                                 h5_spec_inds=self.h5_main.h5_spec_inds,
+                                                 h5_spec_vals=self.h5_main.h5_spec_vals)
+
+        if self.verbose and self.mpi_rank == 0:
+            print('Created the Corrected_Current dataset')
+
+        # The resistance dataset requires the creation of a new spectroscopic dimension
+        self.h5_resistance = write_main_dataset(self.h5_results_grp, (num_pos, self.num_x_steps), 'Resistance',
+                                                'Resistance', 'GOhms', None, Dimension('Bias', 'V', self.num_x_steps),
+                                                dtype=np.float32, chunks=res_chunks,
+                                                h5_pos_inds=self.h5_main.h5_pos_inds,
+                                                h5_pos_vals=self.h5_main.h5_pos_vals)
+
+        if self.verbose and self.mpi_rank == 0:
+            print('Created the Resistance dataset')
+
+        assert isinstance(self.h5_resistance, USIDataset)  # only here for PyCharm
+        self.h5_new_spec_vals = self.h5_resistance.h5_spec_vals
+
+        if self.mpi_rank == 0:
+            # The bias axis of the results never changes - writing it here keeps the per-chunk write path
+            # free of first-chunk checks:
+            self.h5_new_spec_vals[0, :] = self._full_x_vec
+
+        # The variance is identical to the resistance dataset
+        self.h5_variance = write_main_dataset(self.h5_results_grp, (num_pos, self.num_x_steps), 'R_variance',
+                                              'Resistance', 'GOhms', None, None,
+                                              dtype=np.float32, chunks=res_chunks,
+                                              h5_pos_inds=self.h5_main.h5_pos_inds,
+                                              h5_pos_vals=self.h5_main.h5_pos_vals,
+                                              h5_spec_inds=self.h5_resistance.h5_spec_inds,
+                                              h5_spec_vals=self.h5_new_spec_vals)
+
+        if self.verbose and self.mpi_rank == 0:
+            print('Created the R_variance dataset')
+
+        # The capacitance dataset requires new spectroscopic dimensions as well
+        self.h5_cap = write_main_dataset(self.h5_results_grp, (num_pos, 1), 'Capacitance', 'Capacitance', 'pF', None,
+                                         Dimension('Direction', '', [1]), h5_pos_inds=self.h5_main.h5_pos_inds,
+                                         h5_pos_vals=self.h5_main.h5_pos_vals, dtype=cap_dtype,
+                                         aux_spec_prefix='Cap_Spec_')
+
+        if self.verbose and self.mpi_rank == 0:
+            print('Created the Capacitance dataset. Done creating all results datasets!')
+
+        if self.mpi_size > 1:
+            self.mpi_comm.Barrier()
+        self.h5_main.file.flush()
+
+    def _get_existing_datasets(self):
+        """
+        Extracts references to the existing datasets that hold the results
+        """
+        self.h5_new_spec_vals = self.h5_results_grp['Spectroscopic_Values']
+        self.h5_cap = self.h5_results_grp['Capacitance']
+        self.h5_variance = self.h5_results_grp['R_variance']
+        self.h5_resistance = self.h5_results_grp['Resistance']
+        self.h5_i_corrected = self.h5_results_grp['Corrected_Current']
+
+    def _write_results_chunk(self):
+        """
+        Writes data chunks back to the file
+
+        Intermediate chunks are handed to a background thread so that their I/O overlaps with the computation
+        of the next chunk. The base class updates the 'last_pixel' bookkeeping attribute as soon as this
+        method returns, so a crash while such a write is still in flight can leave the results group marked
+        one chunk further along than the data actually written - resume from an unclean termination with
+        override=True. The final chunk is written synchronously so that a completed computation never ends
+        with writes pending, and exceptions captured by the writer thread are re-raised at the next join
+        point so that a failed write aborts the computation.
+        """
+
+        if self.verbose:
+            print('Rank {} - Started accumulating results for this chunk'.format(self.mpi_rank))
+
+        # Capacitance is always doubled when the halves are fit independently. The 0.25 factor combines the
+        # mean of the two estimates with that halving, applied after a single contiguous row reduction:
+        cap_vec = 0.25 * np.einsum('ij->i', self._cap_chunk)
+
+        # Compensate the current by removing the capacitive contributions, writing into the reused buffer
+        # instead of materializing the two contribution matrices separately:
+        np.multiply(cap_vec[:, np.newaxis], self._i_cor_coef, out=self._i_cor_chunk)
+        np.subtract(self.data, self._i_cor_chunk, out=self._i_cor_chunk)
+
+        if self.verbose:
+            print('Rank {} - Finished accumulating results. Writing results of chunk to h5'.format(self.mpi_rank))
+
+        # Get access to the private variable:
+        pos_in_batch = self._get_pixels_in_current_batch()
+
+        # Fill the fields of the compound array directly rather than paying for a
+        # stack_real_to_compound round trip through a flat float array. The buffer shares the
+        # (num_pixels, 1) shape of the dataset, so no reshape is needed at write time:
+        self._cap_write_buffer['Forward'] = self._cap_chunk[:, :1] * 1000  # convert from nF to pF
+        self._cap_write_buffer['Reverse'] = self._cap_chunk[:, 1:] * 1000
+
+        # The batch covering the last rows of the dataset must be written synchronously - the base class
+        # flushes the file and declares the computation complete right after the final chunk:
+        is_last_batch = pos_in_batch[-1] + 1 >= self.h5_main.shape[0]
+
+        if self.mpi_size == 1 and not is_last_batch:
+            # Hand the writes to a background thread so that reading and computing the next chunk overlaps
+            # with the I/O. h5py serializes library calls internally, so a single writer thread is safe, and
+            # _unit_computation joins this thread before the buffers are refilled:
+            self._write_thread = Thread(target=self._deferred_write,
+                                        args=(pos_in_batch, self._cap_write_buffer, self._r_var_chunk,
+                                              self._r_inf_chunk, self._i_cor_chunk))
+            self._write_thread.start()
+        else:
+            # Potentially collective MPI writes cannot be deferred to a thread either:
+            self._write_buffers_to_file(pos_in_batch, self._cap_write_buffer, self._r_var_chunk,
+                                        self._r_inf_chunk, self._i_cor_chunk)
+
+    def _deferred_write(self, pos_in_batch, cap_buffer, r_var_mat, r_inf_mat, i_cor_sin_mat):
+        """
+        Thread target wrapping _write_buffers_to_file(). A raised exception would otherwise die with the
+        thread, letting the base class mark the batch as complete - capture it here so that the join points
+        can re-raise it on the main thread.
+        """
+        try:
+            self._write_buffers_to_file(pos_in_batch, cap_buffer, r_var_mat, r_inf_mat, i_cor_sin_mat)
+        except BaseException as exc:
+            self._write_error = exc
+
+    def _join_write_thread(self):
+        """
+        Waits for any in-flight deferred write and re-raises the exception it captured, if any, so that a
+        failed write fails the computation instead of silently completing it.
+        """
+        if self._write_thread is not None:
+            self._write_thread.join()
+            self._write_thread = None
+        if self._write_error is not None:
+            write_error = self._write_error
+            self._write_error = None
+            raise write_error
+
+    def _write_buffers_to_file(self, pos_in_batch, cap_buffer, r_var_mat, r_inf_mat, i_cor_sin_mat):
+        """
+        Writes the packed result buffers for a single chunk to the HDF5 datasets
+        """
+        pos_in_batch = np.asarray(pos_in_batch)
+        pairs = [(self.h5_cap, cap_buffer), (self.h5_variance, r_var_mat),
+                 (self.h5_resistance, r_inf_mat), (self.h5_i_corrected, i_cor_sin_mat)]
+        if pos_in_batch.size > 0 and np.all(np.diff(pos_in_batch) == 1):
+            # The batch covers a contiguous block of rows, so write_direct can move the C-ordered buffers
+            # into the file without h5py's intermediate selection and broadcasting copies:
+            dest_sel = np.s_[pos_in_batch[0]:pos_in_batch[-1] + 1, :]
+            for h5_dset, buffer in pairs:
+                h5_dset.write_direct(np.ascontiguousarray(buffer), dest_sel=dest_sel)
+        else:
+            for h5_dset, buffer in pairs:
+                h5_dset[pos_in_batch, :] = buffer
+
+    def _unit_computation(self, *args, **kwargs):
+        """
+        Processing per chunk of the dataset
+
+        Parameters
+        ----------
+        args : list
+            Not used
+        kwargs : dictionary
+            Not used
+        """
+        # Cast the raw chunk to contiguous float32 once so that neither the workers nor the correction
+        # arithmetic pay for implicit per-operation dtype conversions against the float32 results:
+        if self.data.dtype != np.float32:
+            self.data = np.ascontiguousarray(self.data, dtype=np.float32)
+
+        # A single pool dispatch covers both halves of every pixel in this chunk. The task function slices the
+        # raw rows itself, which makes rolling the chunk ahead of time unnecessary:
+        all_results = parallel_compute(self.data, _full_period_inference, cores=self._cores,
+                                       func_args=[self._rev_bias, self._forw_bias, self.ex_freq, self._split_ind],
+                                       func_kwargs=self._bayes_parms,
+                                       verbose=self.verbose)
+        self.forward_results = [item[0] for item in all_results]
+        self.reverse_results = [item[1] for item in all_results]
+
+        if self.verbose and self.mpi_rank == 0:
+            print('Rank {} - Finished processing this chunk'.format(self.mpi_rank))
+
+        # The deferred writer may still be flushing the previous chunk out of these buffers - wait for it
+        # (re-raising any write failure) before they are refilled:
+        self._join_write_thread()
+
+        # Unpack the per-pixel result dictionaries into one array per quantity (structure-of-arrays) so that
+        # the write stage can hand complete matrices to HDF5 without further rearrangement. Every element is
+        # overwritten below, so the buffers are reallocated only when the chunk size changes:
+        num_pixels = len(self.forward_results)
+        half_x_steps = self.num_x_steps // 2
+        if self._cap_chunk is None or self._cap_chunk.shape[0] != num_pixels:
+            self._cap_chunk = np.empty((num_pixels, 2), dtype=np.float32)
+            self._r_inf_chunk = np.empty((num_pixels, self.num_x_steps), dtype=np.float32)
+            self._r_var_chunk = np.empty((num_pixels, self.num_x_steps), dtype=np.float32)
+            self._i_cor_chunk = np.empty((num_pixels, self.single_ao.size), dtype=np.float32)
+            self._cap_write_buffer = np.empty((num_pixels, 1), dtype=cap_dtype)
+        self._cap_chunk[:, 0] = [item['cValue'] for item in self.forward_results]
+        self._cap_chunk[:, 1] = [item['cValue'] for item in self.reverse_results]
+        self._r_inf_chunk[:, :half_x_steps] = [item['mR'] for item in self.forward_results]
+        self._r_inf_chunk[:, half_x_steps:] = [item['mR'][::-1] for item in self.reverse_results]
+        self._r_var_chunk[:, :half_x_steps] = [item['vR'] for item in self.forward_results]
+        self._r_var_chunk[:, half_x_steps:] = [item['vR'][::-1] for item in self.reverse_results]
+
+    def compute(self, override=False, *args, **kwargs):
+        """
+        Creates placeholders for the results, applies the inference to the dataset, and writes the output to the file.
+
+        Parameters
+        ----------
+        override : bool, optional. default = False
+            By default, compute will simply return duplicate results to avoid recomputing or resume computation on a
+            group with partial results. Set to True to force fresh computation.
+        args : list
+            Not used
+        kwargs : dictionary
+            Not used
+
+        Returns
+        -------
+        h5_results_grp : h5py.Group object
+            Group containing all the results
+        """
+        # Half the x points are used for each half of the waveform:
+        self._bayes_parms = self.parms_dict.copy()
+        self._bayes_parms['num_x_steps'] = self.num_x_steps // 2
+        self._bayes_parms['econ'] = True
+        del(self._bayes_parms['freq'])
+
+        h5_results_grp = super(GIVBayesian, self).compute(override=override, *args, **kwargs)
+
+        # The final batch is written synchronously, but make sure no deferred write is still in flight and
+        # surface any failure it captured:
+        self._join_write_thread()
+
+        return h5_results_grp
@@ -1,3 +1,4 @@
 from . import atom_finding
+from . import giv_utils
 
-__all__ = ['atom_finding', 'atom_finding_general_gaussian']
+__all__ = ['atom_finding', 'atom_finding_general_gaussian', 'giv_utils']
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Utilities for Bayesian inference of resistance and capacitance from General-mode I-V spectroscopy data
+
+Created on Thu Nov 02 11:48:53 2017
+
+@author: Suhas Somnath, Kody J. Law, Rama K. Vasudevan
+
+"""
+
+from __future__ import division, print_function, absolute_import
+from numbers import Number
+import numpy as np
+import matplotlib.pyplot as plt
+
+from sidpy.viz.plot_utils import set_tick_font_size
+
+cap_dtype = np.dtype({'names': ['Forward', 'Reverse'],
+                      'formats': [np.float32, np.float32]})
+
+# Operators cached by _get_inference_operators(), keyed by the bias waveform and inference parameters:
+_operators_cache = {}
+
+
+def _get_inference_operators(bias, freq, num_x_steps, r_extra, gam, e, sigma, sigmaC):
+    """
+    Builds the pixel-independent operators used by do_bayesian_inference() for a given bias waveform and set
+    of inference parameters. The operators are cached so that repeated calls over a dataset (whose pixels all
+    share the same excitation) only pay for the expensive linear algebra once per process.
+
+    Parameters
+    ----------
+    bias : 1D float array
+        Excitation bias (V) as a function of time
+    freq : float
+        Frequency of the excitation waveform (Hz)
+    num_x_steps : uint
+        Number of bias points at which the resistance will be inferred. Must already be odd
+    r_extra : float
+        Extra resistance (Ohms) in series with the sample
+    gam : float
+        Expected magnitude of the measurement noise on the current (nA)
+    e : float
+        Unused. Retained so that the cache key and signature match do_bayesian_inference()
+    sigma : float
+        Standard deviation of the smoothness prior on the conductance
+    sigmaC : float
+        Standard deviation of the prior on the capacitance
+
+    Returns
+    -------
+    x : 1D float array
+        Bias vector (V) over which the resistance will be inferred
+    A : 2D float array
+        Forward model matrix mapping [conductance, capacitance] to current
+    gain_mat : 2D float array
+        Matrix mapping the measured current to the data-dependent part of the posterior mean
+    mean_offset : 1D float array
+        Pixel-independent contribution of the prior mean to the posterior mean
+    sigma_mat : 2D float array
+        Posterior covariance matrix
+    chol_mat : 2D float array
+        Cholesky factor of the posterior covariance used for drawing samples
+    """
+    key = (bias.tobytes(), freq, num_x_steps, r_extra, gam, e, sigma, sigmaC)
+    try:
+        return _operators_cache[key]
+    except KeyError:
+        pass
+
+    # Organize the problem:
+    t_max = 1. / freq
+    t = np.linspace(0, t_max, bias.size)
+    dt = t[2] - t[1]
+    dv = np.empty(bias.size)
+    dv[:-1] = np.diff(bias) / dt
+    dv[-1] = dv[-2]
+    max_volts = np.max(np.abs(bias))
+    x = np.linspace(-max_volts, max_volts, num_x_steps)
+    dx = x[1] - x[0]
+    num_volt_points = bias.size
+
+    # Forward model: measured current = bias * conductance interpolated at that bias + capacitive contribution.
+    # The unknowns are the conductance at each point of x plus the capacitance (last column):
+    ix = np.clip(np.floor((bias + max_volts) / dx).astype(np.int64) + 1, 1, num_x_steps - 1)
+    frac = (bias - x[ix - 1]) / (x[ix] - x[ix - 1])
+    A = np.zeros(shape=(num_volt_points, num_x_steps + 1))
+    rows = np.arange(num_volt_points)
+    A[rows, ix] = bias * frac
+    A[rows, ix - 1] = bias * (1. - frac)
+    A[:, num_x_steps] = dv + r_extra * bias
+
+    # Smoothness prior on the conductance with precision (1 / sigma ** 2) * (I + Lap ** 3), where Lap is the
+    # 1D Laplacian with 1 / dx ** 2 end points, along with a broad prior on the capacitance and a nonzero
+    # prior mean of 3 on the conductance:
+    lapl = (- np.diag(np.ones(num_x_steps - 1), -1) - np.diag(np.ones(num_x_steps - 1), 1)
+            + 2. * np.diag(np.ones(num_x_steps))) / dx ** 2
+    lapl[0, 0] = 1. / dx ** 2
+    lapl[-1, -1] = 1. / dx ** 2
+    prior_prec = np.zeros(shape=(num_x_steps + 1, num_x_steps + 1))
+    prior_prec[:num_x_steps, :num_x_steps] = (np.eye(num_x_steps) + np.linalg.matrix_power(lapl, 3)) / sigma ** 2
+    prior_prec[-1, -1] = 1. / sigmaC ** 2
+    prior_mean = np.zeros(num_x_steps + 1)
+    prior_mean[:num_x_steps] = 3.
+
+    # The model is linear and the priors are Gaussian, so the posterior is Gaussian as well. The contribution
+    # of the prior mean to the posterior mean does not depend on the measured current, so it is folded into
+    # the cached operators as a fixed offset:
+    post_prec = np.dot(A.T, A) / gam ** 2 + prior_prec
+    sigma_mat = np.linalg.inv(post_prec)
+    gain_mat = np.dot(sigma_mat, A.T) / gam ** 2
+    mean_offset = np.dot(sigma_mat, np.dot(prior_prec, prior_mean))
+    chol_mat = np.linalg.cholesky(sigma_mat)
+
+    operators = x, A, gain_mat, mean_offset, sigma_mat, chol_mat
+
+    # Only a handful of distinct waveforms (the two halves of the excitation) are ever seen in practice -
+    # guard against pathological growth anyway:
+    if len(_operators_cache) > 4:
+        _operators_cache.clear()
+    _operators_cache[key] = operators
+    return operators
+
+
+def do_bayesian_inference(i_meas, bias, freq, num_x_steps=251, r_extra=110, gam=0.03, e=10.0, sigma=10., sigmaC=1.,
+                          num_samples=2E3, show_plots=False, econ=False):
+    """
+    Infers the bias-dependent resistance and the (constant) capacitance for a single I-V curve by solving
+    I = V / R(V) + C * dV/dt via Bayesian linear inversion.
+
+    Parameters
+    ----------
+    i_meas : 1D array-like
+        Measured current (nA) as a function of time
+    bias : 1D array-like
+        Excitation bias (V) as a function of time. The bias must be monotonic, meaning that this function must be
+        called separately on the rising and falling halves of a bipolar waveform.
+    freq : float
+        Frequency of the excitation waveform (Hz)
+    num_x_steps : uint (Optional, default = 251)
+        Number of bias points at which the resistance will be inferred. Will be forced to be odd so that the bias
+        vector includes 0 V
+    r_extra : float (Optional, default = 110 [Ohms])
+        Extra resistance in series with the sample that compensates for the effect of the cabling
+    gam : float (Optional, default = 0.03)
+        Expected magnitude of the measurement noise on the current (nA)
+    e : float (Optional, default = 10.0)
+        Unused. Retained for compatibility with earlier versions of this function
+    sigma : float (Optional, default = 10.0)
+        Standard deviation of the smoothness prior on the conductance
+    sigmaC : float (Optional, default = 1.0)
+        Standard deviation of the prior on the capacitance
+    num_samples : uint (Optional, default = 2E3)
+        Number of posterior samples used to estimate the mean and variance of the resistance
+    show_plots : bool (Optional, default = False)
+        Whether or not to plot the inferred resistance and reconstructed current
+    econ : bool (Optional, default = False)
+        Whether or not to return only the estimates instead of the full posterior. Turn this on when applying this
+        function over entire datasets to substantially lower the memory requirements
+
+    Returns
+    -------
+    results : dict
+        Dictionary with the inference results:
+
+        'x' : 1D float array - bias vector (V) over which the resistance was inferred
+        'mR' : 1D float array - inferred resistance (GOhm) at each bias point
+        'vR' : 1D float array - variance of the inferred resistance at each bias point
+        'Irec' : 1D float array - reconstructed current (nA)
+        'cValue' : float - inferred capacitance (nF)
+
+        When econ is False the dictionary also contains:
+
+        'm' : 1D float array - posterior mean of the conductance with the capacitance as the last element
+        'Sigma' : 2D float array - posterior covariance matrix
+        'SI' : 2D float array - posterior samples of the reconstructed current arranged as [sample, time]
+    """
+    if not isinstance(i_meas, (np.ndarray, list)):
+        raise TypeError('i_meas should be array-like')
+    if not isinstance(bias, (np.ndarray, list)):
+        raise TypeError('bias should be array-like')
+    if not isinstance(freq, Number) or freq <= 0:
+        raise ValueError('freq should be a positive number')
+
+    i_meas = np.array(i_meas)
+    bias = np.array(bias)
+    if i_meas.shape != bias.shape or i_meas.ndim != 1:
+        raise ValueError('i_meas and bias should be 1D arrays of the same size')
+
+    num_samples = int(num_samples)
+    # Always keep num_x_steps odd so that the bias vector includes 0 V. Setting the lowest bit does this
+    # without a branch, which also keeps this per-pixel entry point trivially cheap:
+    num_x_steps = int(num_x_steps) | 1
+
+    # Everything except the products below depends only on the bias waveform and the parameters, all of
+    # which are shared by every pixel of a dataset - fetch the precomputed operators:
+    x, A, gain_mat, mean_offset, sigma_mat, chol_mat = _get_inference_operators(bias, freq, num_x_steps,
+                                                                                r_extra, gam, e, sigma, sigmaC)
+
+    m = np.dot(gain_mat, i_meas) + mean_offset
+    i_recon = np.dot(A, m)
+    cap_val = m[-1]
+
+    # Push posterior samples of the conductance through 1 / G to get the resistance statistics:
+    samples = m + np.dot(np.random.randn(num_samples, m.size), chol_mat.T)
+    r_samples = 1. / samples[:, :num_x_steps]
+    m_r = np.mean(r_samples, axis=0)
+    v_r = np.var(r_samples, axis=0)
+
+    # The bias vector and posterior covariance live in the operator cache shared by every call with the same
+    # waveform - hand out copies so that callers mutating their results cannot corrupt the cache:
+    results = {'x': x.copy(), 'mR': m_r, 'vR': v_r, 'Irec': i_recon, 'cValue': cap_val}
+    if not econ:
+        results.update({'m': m, 'Sigma': sigma_mat.copy(), 'SI': np.dot(samples, A.T)})
+
+    if show_plots:
+        fig, axes = plt.subplots(figsize=(11, 5), ncols=2)
+        axes[0].plot(bias, i_meas, 'r', label='Measured')
+        axes[0].plot(bias, i_recon, 'k--', label='Reconstructed')
+        axes[0].legend(fontsize=14)
+        axes[0].set_xlabel('Bias (V)', fontsize=14)
+        axes[0].set_ylabel('Current (nA)', fontsize=14)
+        axes[1].plot(x, m_r, 'b')
+        axes[1].fill_between(x, m_r - np.sqrt(v_r), m_r + np.sqrt(v_r), color='b', alpha=0.25)
+        axes[1].set_xlabel('Bias (V)', fontsize=14)
+        axes[1].set_ylabel('Resistance (GOhm)', fontsize=14)
+        set_tick_font_size(axes, 14)
+        fig.tight_layout()
+
+    return results
+
+
+def bayesian_inference_on_period(i_meas, excit_wfm, ex_freq, r_extra=110, num_x_steps=250, show_plots=False,
+                                 **kwargs):
+    """
+    Performs Bayesian inference on a single I-V curve spanning one complete period of a bipolar excitation waveform.
+    The curve is rolled such that it starts from the most negative bias and is then split into its rising and falling
+    halves, each of which is inferred independently and recombined.
+
+    Parameters
+    ----------
+    i_meas : 1D array-like
+        Measured current (nA) for a single period of the excitation waveform
+    excit_wfm : 1D array-like
+        Excitation bias waveform (V) corresponding to the measured current
+    ex_freq : float
+        Frequency of the excitation waveform (Hz)
+    r_extra : float (Optional, default = 110 [Ohms])
+        Extra resistance in series with the sample that compensates for the effect of the cabling
+    num_x_steps : uint (Optional, default = 250)
+        Total number of bias points at which the resistance will be inferred over both halves of the waveform
+    show_plots : bool (Optional, default = False)
+        Whether or not to plot the inferred resistance and corrected current
+    kwargs : dict
+        Other parameters that will be passed on to do_bayesian_inference()
+
+    Returns
+    -------
+    results : dict
+        Dictionary with the recombined inference results:
+
+        'x' : 1D float array - bias vector (V) over which the resistance was inferred
+        'mR' : 1D float array - inferred resistance (GOhm) at each bias point
+        'vR' : 1D float array - variance of the inferred resistance at each bias point
+        'Irec' : 1D float array - reconstructed current (nA)
+        'cValue' : float - inferred capacitance (nF)
+        'i_corrected' : 1D float array - current (nA) after removing the capacitive contribution
+    """
+    i_meas = np.array(i_meas)
+    excit_wfm = np.array(excit_wfm)
+    if i_meas.shape != excit_wfm.shape or i_meas.ndim != 1:
+        raise ValueError('i_meas and excit_wfm should be 1D arrays of the same size')
+
+    roll_pts = int(-0.25 * excit_wfm.size)
+    rolled_bias = np.roll(excit_wfm, roll_pts)
+    rolled_i = np.roll(i_meas, roll_pts)
+    half_pt = rolled_bias.size // 2
+    half_x_steps = num_x_steps // 2
+
+    # The model is odd in (I, V), so the falling half of the waveform can be inferred directly:
+    rev_results = do_bayesian_inference(rolled_i[:half_pt], rolled_bias[:half_pt], ex_freq,
+                                        num_x_steps=half_x_steps, r_extra=r_extra, econ=True, **kwargs)
+    forw_results = do_bayesian_inference(rolled_i[half_pt:], rolled_bias[half_pt:], ex_freq,
+                                         num_x_steps=half_x_steps, r_extra=r_extra, econ=True, **kwargs)
+
+    # Capacitance is always doubled when halves are fit independently - halve it now:
+    cap_val = 0.5 * np.mean([forw_results['cValue'], rev_results['cValue']])
+
+    # Remove the capacitive contributions from the measured current:
+    dt = 1. / (ex_freq * excit_wfm.size)
+    dvdt = np.empty(excit_wfm.size)
+    dvdt[:-1] = np.diff(excit_wfm) / dt
+    dvdt[-1] = dvdt[-2]
+    i_cap = cap_val * dvdt
+    i_extra = 2 * r_extra * cap_val * excit_wfm
+    i_corrected = i_meas - i_cap - i_extra
+
+    results = {'x': np.hstack((forw_results['x'], rev_results['x'][::-1])),
+               'mR': np.hstack((forw_results['mR'], rev_results['mR'][::-1])),
+               'vR': np.hstack((forw_results['vR'], rev_results['vR'][::-1])),
+               'Irec': np.roll(np.hstack((rev_results['Irec'], forw_results['Irec'])), -roll_pts),
+               'cValue': cap_val,
+               'i_corrected': i_corrected}
+
+    if show_plots:
+        fig, axes = plt.subplots(figsize=(11, 5), ncols=2)
+        axes[0].plot(excit_wfm, i_meas, 'r', label='Measured')
+        axes[0].plot(excit_wfm, i_corrected, 'k', label='Corrected')
+        axes[0].legend(fontsize=14)
+        axes[0].set_xlabel('Bias (V)', fontsize=14)
+        axes[0].set_ylabel('Current (nA)', fontsize=14)
+        axes[0].set_title('C = {:.2f} pF'.format(cap_val * 1000), fontsize=16)
+        sort_inds = np.argsort(results['x'])
+        x_sorted = results['x'][sort_inds]
+        m_r = results['mR'][sort_inds]
+        v_r = results['vR'][sort_inds]
+        axes[1].plot(x_sorted, m_r, 'b')
+        axes[1].fill_between(x_sorted, m_r - np.sqrt(v_r), m_r + np.sqrt(v_r), color='b', alpha=0.25)
+        axes[1].set_xlabel('Bias (V)', fontsize=14)
+        axes[1].set_ylabel('Resistance (GOhm)', fontsize=14)
+        set_tick_font_size(axes, 14)
+        fig.tight_layout()
+
+    return results
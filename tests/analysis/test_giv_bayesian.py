@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Aug 31 10:14:27 2020
+
+@author: Suhas Somnath
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import h5py
+
+sys.path.append("../../../pycroscopy/")
+from pyUSID.io.hdf_utils import write_main_dataset
+from pyUSID.io.write_utils import Dimension
+from pycroscopy.analysis import GIVBayesian
+
+ex_freq = 1.0
+num_steps = 128
+num_pix = 6
+r_true = 5.0  # GOhm
+c_true = 1.0  # nF
+
+
+def _make_raw_data(seed=42):
+    t = np.arange(num_steps) / num_steps
+    bias = 6. * np.sin(2 * np.pi * t)
+    dt = 1. / (ex_freq * num_steps)
+    dvdt = np.empty(num_steps)
+    dvdt[:-1] = np.diff(bias) / dt
+    dvdt[-1] = dvdt[-2]
+    raw = bias / r_true + c_true * dvdt
+    raw = raw + 0.03 * np.random.RandomState(seed).randn(num_pix, num_steps)
+    return bias, raw.astype(np.float32)
+
+
+class TestGIVBayesian(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.h5_f = h5py.File(os.path.join(self.temp_dir, 'giv_raw.h5'), 'w')
+        h5_chan_grp = self.h5_f.create_group('Measurement_000/Channel_000')
+        self.bias, raw = _make_raw_data()
+        self.h5_main = write_main_dataset(h5_chan_grp, raw, 'Raw_Data', 'Current', 'nA',
+                                          Dimension('X', 'm', num_pix), Dimension('Bias', 'V', self.bias))
+
+    def tearDown(self):
+        self.h5_f.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_num_x_steps_forced_to_even_pair_of_odd_halves(self):
+        proc = GIVBayesian(self.h5_main, ex_freq, 8, num_x_steps=250, r_extra=0, cores=1)
+        # Each half of the waveform needs an odd number of bias points for the axis to include 0 V:
+        self.assertEqual(proc.num_x_steps, 250)
+        proc = GIVBayesian(self.h5_main, ex_freq, 8, num_x_steps=252, r_extra=0, cores=1)
+        self.assertEqual(proc.num_x_steps, 254)
+
+    def test_test_on_single_pixel(self):
+        proc = GIVBayesian(self.h5_main, ex_freq, 8, num_x_steps=30, r_extra=0, cores=1)
+        results = proc.test(pix_ind=0, show_plots=False)
+        for key in ['x', 'mR', 'vR', 'cValue', 'i_corrected']:
+            self.assertIn(key, results)
+        self.assertEqual(results['mR'].size, proc.num_x_steps)
+
+    def test_failed_deferred_write_aborts_compute(self):
+        proc = GIVBayesian(self.h5_main, ex_freq, 8, num_x_steps=30, r_extra=0, cores=1)
+        # Force several batches so that the intermediate ones go through the deferred writer:
+        proc._max_pos_per_read = 4
+
+        def failing_write(pos_in_batch, *buffers):
+            raise IOError('simulated write failure')
+
+        proc._write_buffers_to_file = failing_write
+        # The failure happens on the writer thread - it must surface on the main thread instead of letting
+        # compute() return a results group that is flagged complete but missing data:
+        with self.assertRaises(IOError):
+            proc.compute()
+
+    def test_compute_writes_results(self):
+        np.random.seed(0)
+        proc = GIVBayesian(self.h5_main, ex_freq, 8, num_x_steps=30, r_extra=0, cores=1)
+        # Force several (unequally sized) batches so that the buffer reuse and deferred writes are exercised:
+        proc._max_pos_per_read = 4
+        h5_grp = proc.compute()
+
+        for dset_name in ['Capacitance', 'Corrected_Current', 'R_variance', 'Resistance']:
+            self.assertIn(dset_name, h5_grp)
+        self.assertEqual(h5_grp['Capacitance'].shape, (num_pix, 1))
+        self.assertEqual(h5_grp['Corrected_Current'].shape, (num_pix, num_steps))
+        self.assertEqual(h5_grp['Resistance'].shape, (num_pix, proc.num_x_steps))
+
+        # The bias axis of the results: ascending rising half followed by the descending falling half:
+        x_vec = h5_grp['Spectroscopic_Values'][0]
+        forw_x = np.linspace(-6., 6., proc.num_x_steps // 2)
+        self.assertTrue(np.allclose(x_vec, np.hstack((forw_x, forw_x[::-1])), atol=1E-4))
+
+        # Each half is inferred over the full nominal period, so its capacitance comes out doubled:
+        cap = h5_grp['Capacitance'][()]
+        for field in ['Forward', 'Reverse']:
+            self.assertLess(np.max(np.abs(cap[field] / 1000. - 2 * c_true)) / (2 * c_true), 0.1)
+
+        # The resistance is well constrained away from 0 V and from the edges of the bias range:
+        resistance = h5_grp['Resistance'][()]
+        mid_band = np.where(np.logical_and(np.abs(x_vec) > 2, np.abs(x_vec) < 5.5))[0]
+        max_rel_err = np.max(np.abs(resistance[:, mid_band] - r_true)) / r_true
+        self.assertLess(max_rel_err, 0.35)
+
+        # Removing the capacitive contribution should leave (nearly) the purely resistive current:
+        i_corrected = h5_grp['Corrected_Current'][()]
+        self.assertLess(np.max(np.abs(i_corrected - self.bias / r_true)), 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
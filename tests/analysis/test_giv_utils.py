@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Aug 31 10:14:27 2020
+
+@author: Suhas Somnath
+"""
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+import unittest
+import sys
+import numpy as np
+
+sys.path.append("../../../pycroscopy/")
+from pycroscopy.analysis.utils.giv_utils import do_bayesian_inference, bayesian_inference_on_period
+
+ex_freq = 1.0
+r_true = 5.0  # GOhm
+c_true = 1.0  # nF
+
+
+def _internal_dvdt(bias, freq):
+    # dV/dt exactly as do_bayesian_inference() computes it internally
+    t_max = 1. / freq
+    t = np.linspace(0, t_max, bias.size)
+    dt = t[2] - t[1]
+    dvdt = np.empty(bias.size)
+    dvdt[:-1] = np.diff(bias) / dt
+    dvdt[-1] = dvdt[-2]
+    return dvdt
+
+
+class TestDoBayesianInference(unittest.TestCase):
+
+    @staticmethod
+    def _make_ramp_data(noise_level=0.03, seed=42):
+        bias = np.linspace(-6., 6., 128)
+        i_meas = bias / r_true + c_true * _internal_dvdt(bias, ex_freq)
+        i_meas += noise_level * np.random.RandomState(seed).randn(bias.size)
+        return bias, i_meas
+
+    def test_invalid_inputs(self):
+        bias, i_meas = self._make_ramp_data()
+        with self.assertRaises(TypeError):
+            do_bayesian_inference('not an array', bias, ex_freq)
+        with self.assertRaises(TypeError):
+            do_bayesian_inference(i_meas, 'not an array', ex_freq)
+        with self.assertRaises(ValueError):
+            do_bayesian_inference(i_meas, bias, -1)
+        with self.assertRaises(ValueError):
+            do_bayesian_inference(i_meas, bias[:-1], ex_freq)
+
+    def test_num_x_steps_forced_odd(self):
+        bias, i_meas = self._make_ramp_data()
+        results = do_bayesian_inference(i_meas, bias, ex_freq, num_x_steps=100, r_extra=0, econ=True)
+        self.assertEqual(results['x'].size, 101)
+        self.assertEqual(results['mR'].size, 101)
+        self.assertEqual(results['vR'].size, 101)
+
+    def test_recovers_resistance_and_capacitance(self):
+        np.random.seed(0)
+        bias, i_meas = self._make_ramp_data()
+        results = do_bayesian_inference(i_meas, bias, ex_freq, num_x_steps=101, r_extra=0, econ=True)
+        # The resistance is well constrained only where the bias (and hence the resistive current) is
+        # appreciable - stay away from 0 V and from the edges of the bias range:
+        mid_band = np.where(np.logical_and(np.abs(results['x']) > 2, np.abs(results['x']) < 5.5))[0]
+        max_rel_err = np.max(np.abs(results['mR'][mid_band] - r_true)) / r_true
+        self.assertLess(max_rel_err, 0.2)
+        self.assertLess(np.abs(results['cValue'] - c_true) / c_true, 0.1)
+        self.assertLess(np.max(np.abs(results['Irec'] - i_meas)), 0.5)
+
+    def test_econ_toggles_posterior_in_results(self):
+        bias, i_meas = self._make_ramp_data()
+        results = do_bayesian_inference(i_meas, bias, ex_freq, num_x_steps=51, r_extra=0, econ=True)
+        for key in ['m', 'Sigma', 'SI']:
+            self.assertNotIn(key, results)
+        results = do_bayesian_inference(i_meas, bias, ex_freq, num_x_steps=51, r_extra=0, econ=False)
+        self.assertEqual(results['m'].size, 51 + 1)
+        self.assertEqual(results['Sigma'].shape, (51 + 1, 51 + 1))
+
+    def test_results_do_not_alias_cached_operators(self):
+        bias, i_meas = self._make_ramp_data()
+        results = do_bayesian_inference(i_meas, bias, ex_freq, num_x_steps=51, r_extra=0, econ=False)
+        results['x'] *= -1
+        results['Sigma'][:] = 0
+        fresh = do_bayesian_inference(i_meas, bias, ex_freq, num_x_steps=51, r_extra=0, econ=False)
+        self.assertTrue(np.allclose(fresh['x'], np.linspace(-6., 6., 51)))
+        self.assertTrue(np.any(fresh['Sigma'] != 0))
+
+
+class TestBayesianInferenceOnPeriod(unittest.TestCase):
+
+    @staticmethod
+    def _make_period_data(num_steps=256, noise_level=0.03, seed=42):
+        t = np.arange(num_steps) / num_steps
+        bias = 6. * np.sin(2 * np.pi * t)
+        dt = 1. / (ex_freq * num_steps)
+        dvdt = np.empty(num_steps)
+        dvdt[:-1] = np.diff(bias) / dt
+        dvdt[-1] = dvdt[-2]
+        i_meas = bias / r_true + c_true * dvdt
+        i_meas += noise_level * np.random.RandomState(seed).randn(num_steps)
+        return bias, i_meas
+
+    def test_recombined_results(self):
+        np.random.seed(0)
+        bias, i_meas = self._make_period_data()
+        results = bayesian_inference_on_period(i_meas, bias, ex_freq, r_extra=0, num_x_steps=250)
+        for key in ['x', 'mR', 'vR', 'cValue', 'i_corrected']:
+            self.assertIn(key, results)
+        # Rising half on an ascending bias axis followed by the falling half in descending order:
+        self.assertEqual(results['x'].size, 250)
+        self.assertTrue(np.all(np.diff(results['x'][:125]) > 0))
+        self.assertTrue(np.all(np.diff(results['x'][125:]) < 0))
+        self.assertEqual(results['mR'].size, 250)
+        self.assertEqual(results['i_corrected'].size, bias.size)
+        # Each half is inferred over the full nominal period, so the capacitance of each half comes out
+        # doubled. bayesian_inference_on_period() already compensates for this:
+        self.assertLess(np.abs(results['cValue'] - c_true) / c_true, 0.1)
+        # Removing the capacitive contribution should leave (nearly) the purely resistive current:
+        self.assertLess(np.max(np.abs(results['i_corrected'] - bias / r_true)), 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()